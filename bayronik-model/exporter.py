@@ -15,6 +15,7 @@ def export_model_to_torchscript():
     # --- 1. Define Paths ---
     weights_path = os.path.join(config.WEIGHTS_DIR, config.MODEL_NAME)
     export_path = os.path.join(config.WEIGHTS_DIR, "traced_unet_model.pt")
+    onnx_export_path = os.path.splitext(export_path)[0] + ".onnx"
 
     # --- 2. Check if the trained weights file exists ---
     if not os.path.exists(weights_path):
@@ -44,11 +45,36 @@ def export_model_to_torchscript():
     traced_script_module = torch.jit.trace(model, dummy_input)
     print("Model traced successfully.")
 
+    # Freezing inlines the weights as constants and folds each BatchNorm
+    # into its preceding Conv, so inference runs fewer, fused ops.
+    # (optimize_for_inference is deliberately not used: on a CPU export it
+    # bakes in MKLDNN layout conversions, but the Rust side may run on CUDA.)
+    print("Freezing traced model...")
+    traced_script_module = torch.jit.freeze(traced_script_module.eval())
+    print("Model frozen successfully.")
+
     # --- 5. Save the Traced Model ---
     traced_script_module.save(export_path)
     print(f"\n--- Export SUCCESSFUL ---")
     print(f"TorchScript model saved to: {export_path}")
 
+    # --- 6. Export to ONNX with Dynamic Shapes ---
+    # The traced module is specialized on a 1x1x256x256 input; the ONNX
+    # graph keeps batch size and resolution dynamic, so runtimes such as
+    # ONNX Runtime can take other shapes without re-specializing.
+    print("\nExporting model to ONNX with dynamic batch and spatial axes...")
+    dynamic_axes = {0: 'batch', 2: 'height', 3: 'width'}
+    torch.onnx.export(
+        model,
+        dummy_input,
+        onnx_export_path,
+        input_names=['input'],
+        output_names=['output'],
+        dynamic_axes={'input': dynamic_axes, 'output': dynamic_axes},
+        opset_version=17,
+    )
+    print(f"ONNX model saved to: {onnx_export_path}")
+
 if __name__ == "__main__":
     export_model_to_torchscript()
 
@@ -0,0 +1,87 @@
+import os
+import h5py
+import hdf5plugin
+import numpy as np
+
+import config
+
+# Number of maps normalized and written per block, to bound memory use
+BLOCK_SIZE = 256
+
+
+def preprocessed_filename(field, suite, dataset_type, redshift=0.0):
+    """File name of a log1p-normalized, Bitshuffle+LZ4 compressed map file."""
+    return f"Maps_{field}_{suite}_{dataset_type}_z={redshift:.2f}_log1p.hdf5"
+
+
+def load_raw_maps(field, suite, dataset_type, redshift=0.0):
+    """
+    Open the raw maps for a field, preferring the CAMELS HDF5 file and
+    falling back to the .npy file. Returns (array-like, file handle or None).
+    """
+    hdf5_path = os.path.join(config.DATA_DIR, f"Maps_{field}_{suite}_{dataset_type}_z={redshift:.2f}.hdf5")
+    npy_path = os.path.join(config.DATA_DIR, f"Maps_{field}_{suite}_{dataset_type}_z={redshift:.2f}.npy")
+
+    if os.path.exists(hdf5_path):
+        print(f"  Reading: {hdf5_path}")
+        f = h5py.File(hdf5_path, 'r')
+        return f[f"Maps_{field}"], f
+    if os.path.exists(npy_path):
+        print(f"  Reading: {npy_path}")
+        return np.load(npy_path, mmap_mode='r'), None
+
+    raise FileNotFoundError(
+        f"No raw maps found for {field}. Expected '{hdf5_path}' or '{npy_path}'."
+    )
+
+
+def preprocess_field(field, suite=config.SUITE, dataset_type=config.DATASET_TYPE, redshift=0.0):
+    """
+    Write log1p-normalized maps for one field to a Bitshuffle+LZ4
+    compressed HDF5 file, chunked one map per chunk.
+    """
+    raw_maps, raw_file = load_raw_maps(field, suite, dataset_type, redshift)
+    out_path = os.path.join(config.DATA_DIR, preprocessed_filename(field, suite, dataset_type, redshift))
+    n_maps = raw_maps.shape[0]
+    map_shape = tuple(raw_maps.shape[1:])
+
+    try:
+        with h5py.File(out_path, 'w') as f:
+            ds = f.create_dataset(
+                f"Maps_{field}",
+                shape=(n_maps,) + map_shape,
+                dtype=np.float32,
+                chunks=(1,) + map_shape,
+                **hdf5plugin.Bitshuffle(cname='lz4'),
+            )
+            # Lets the dataset loader know not to normalize again
+            ds.attrs['normalization'] = 'log1p'
+
+            for start in range(0, n_maps, BLOCK_SIZE):
+                stop = min(start + BLOCK_SIZE, n_maps)
+                block = np.asarray(raw_maps[start:stop], dtype=np.float32)
+                ds[start:stop] = np.log1p(block)
+    finally:
+        if raw_file is not None:
+            raw_file.close()
+
+    print(f"  ✓ Wrote {n_maps} maps to: {out_path}")
+
+
+def preprocess_dataset():
+    """
+    One-time conversion of the raw CAMELS maps into log1p-normalized,
+    compressed HDF5 files for CAMELSDatasetHDF5(preprocessed=True).
+    """
+    print("--- Starting Map Preprocessing ---")
+    print(f"Suite: {config.SUITE}, Dataset: {config.DATASET_TYPE}")
+
+    for field in ("Mcdm", "Mtot"):
+        print(f"\nProcessing {field} maps...")
+        preprocess_field(field)
+
+    print("\n--- Preprocessing SUCCESSFUL ---")
+
+
+if __name__ == "__main__":
+    preprocess_dataset()
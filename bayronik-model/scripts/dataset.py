@@ -12,9 +12,18 @@ class CAMELSDataset(Dataset):
         root_dir (str): The directory containing the CAMELS data files.
         suite (str): The simulation suite to use (e.g., 'IllustrisTNG').
         dataset_type (str): The simulation set (e.g., 'CV', 'LH').
+        cache_in_memory (bool): Load the entire dataset into RAM up front
+            (default: False, memory-map the files instead)
+        verbose (bool): Print loading progress (default: True)
+
+    Maps are returned un-normalized (`normalized` is always False); log1p
+    is applied on the training device after the batch has been transferred.
     """
-    def __init__(self, root_dir, suite='IllustrisTNG', dataset_type='CV'):
+    def __init__(self, root_dir, suite='IllustrisTNG', dataset_type='CV', cache_in_memory=False,
+                 verbose=True):
         self.root_dir = root_dir
+        self.cache_in_memory = cache_in_memory
+        self.normalized = False
 
         # Construct the file paths for the required fields
         # Input is Dark Matter (Mcdm)
@@ -25,8 +34,9 @@ class CAMELSDataset(Dataset):
         input_path = os.path.join(root_dir, input_filename)
         target_path = os.path.join(root_dir, target_filename)
 
-        print(f"Loading input maps from: {input_path}")
-        print(f"Loading target maps from: {target_path}")
+        if verbose:
+            print(f"Loading input maps from: {input_path}")
+            print(f"Loading target maps from: {target_path}")
 
         if not os.path.exists(input_path) or not os.path.exists(target_path):
             raise FileNotFoundError(
@@ -34,27 +44,40 @@ class CAMELSDataset(Dataset):
                 "Please ensure both '{input_filename}' and '{target_filename}' are present."
             )
 
-        # Load the entire dataset into memory.
+        # Memory-map the files; pages are pulled in by the OS on access and
+        # shared between DataLoader workers through the page cache.
         # The shape will be (num_simulations, height, width)
-        self.input_maps = np.load(input_path).astype(np.float32)
-        self.target_maps = np.load(target_path).astype(np.float32)
+        self.input_maps = np.load(input_path, mmap_mode='r')
+        self.target_maps = np.load(target_path, mmap_mode='r')
 
         if self.input_maps.shape[0] != self.target_maps.shape[0]:
             raise ValueError("Input and target files have a different number of maps!")
 
-        print(f"Successfully loaded {self.input_maps.shape[0]} map pairs.")
+        if cache_in_memory:
+            # Stored as contiguous tensors of shape (num_simulations, 1, height, width)
+            self.input_maps = torch.from_numpy(
+                self.input_maps.astype(np.float32)
+            ).unsqueeze(1).contiguous()
+            self.target_maps = torch.from_numpy(
+                self.target_maps.astype(np.float32)
+            ).unsqueeze(1).contiguous()
+
+        if verbose:
+            print(f"Successfully loaded {self.input_maps.shape[0]} map pairs.")
 
     def __len__(self):
         return self.input_maps.shape[0]
 
     def __getitem__(self, idx):
-        # Get the specific map from the pre-loaded arrays
-        input_map = self.input_maps[idx]
-        target_map = self.target_maps[idx]
-
-        # Normalize the maps
-        input_map = np.log1p(input_map)
-        target_map = np.log1p(target_map)
+        if self.cache_in_memory:
+            # Maps already carry their channel dimension, so this is just
+            # a view into the pre-loaded tensors.
+            return self.input_maps[idx], self.target_maps[idx]
+
+        # Copy the map out of the memory-mapped file as float32 so no
+        # reference to the mapped pages outlives this call.
+        input_map = np.array(self.input_maps[idx], dtype=np.float32)
+        target_map = np.array(self.target_maps[idx], dtype=np.float32)
 
         # Convert to PyTorch tensors and add a channel dimension
         input_tensor = torch.from_numpy(input_map).unsqueeze(0)
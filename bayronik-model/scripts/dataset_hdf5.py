@@ -1,9 +1,22 @@
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, DataLoader, Sampler
 import h5py
 import numpy as np
 import os
 
+try:
+    # Registers the Bitshuffle/LZ4 filters used by preprocessed files
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+# Raw data chunk cache settings for random-access reads
+H5_CHUNK_CACHE = dict(
+    rdcc_nbytes=512 * 1024 * 1024,  # 512 MB per open file
+    rdcc_nslots=100003,             # Prime, well above the number of cached chunks
+    rdcc_w0=0.75,
+)
+
 class CAMELSDatasetHDF5(Dataset):
     """
     PyTorch Dataset for loading CAMELS 2D projected mass maps from HDF5 files.
@@ -14,12 +27,29 @@ class CAMELSDatasetHDF5(Dataset):
     - Includes metadata (parameters, redshifts, units)
     - Faster random access
     
+    Random access reads whole HDF5 chunks, so the files are opened with a
+    large raw data chunk cache (512 MB) to avoid re-reading and
+    re-decompressing the same chunk across __getitem__ calls. If the
+    files are chunked across many simulations, rechunking them once to
+    one map per chunk makes each sample read exactly one chunk:
+    
+        h5repack -l Maps_Mcdm:CHUNK=1x256x256 in.hdf5 out.hdf5
+    
+    With preprocessed=True the dataset reads the *_log1p.hdf5 files
+    written by preprocess.py instead: maps already log1p-normalized,
+    chunked one per map and Bitshuffle+LZ4 compressed (needs hdf5plugin).
+    The `normalized` attribute is set from the files' own
+    normalization='log1p' tag and tells callers whether log1p still has
+    to be applied on the training device.
+    
     Args:
         root_dir (str): Directory containing HDF5 files
         suite (str): Simulation suite ('IllustrisTNG', 'SIMBA', etc.)
         dataset_type (str): Dataset type ('CV', 'LH', etc.)
         redshift (float): Which redshift slice to load (default: 0.0)
         cache_in_memory (bool): Load entire dataset into RAM (default: False)
+        preprocessed (bool): Read the log1p-normalized files from
+            preprocess.py (default: False)
     """
     def __init__(
         self, 
@@ -27,7 +57,8 @@ class CAMELSDatasetHDF5(Dataset):
         suite='IllustrisTNG', 
         dataset_type='CV',
         redshift=0.0,
-        cache_in_memory=False
+        cache_in_memory=False,
+        preprocessed=False
     ):
         self.root_dir = root_dir
         self.suite = suite
@@ -35,9 +66,16 @@ class CAMELSDatasetHDF5(Dataset):
         self.redshift = redshift
         self.cache_in_memory = cache_in_memory
         
+        if preprocessed and hdf5plugin is None:
+            raise ImportError(
+                "hdf5plugin is required to read preprocessed (Bitshuffle+LZ4) files. "
+                "Install it with: pip install hdf5plugin"
+            )
+        
         # Construct file paths
-        input_filename = f"Maps_Mcdm_{suite}_{dataset_type}_z={redshift:.2f}.hdf5"
-        target_filename = f"Maps_Mtot_{suite}_{dataset_type}_z={redshift:.2f}.hdf5"
+        suffix = "_log1p" if preprocessed else ""
+        input_filename = f"Maps_Mcdm_{suite}_{dataset_type}_z={redshift:.2f}{suffix}.hdf5"
+        target_filename = f"Maps_Mtot_{suite}_{dataset_type}_z={redshift:.2f}{suffix}.hdf5"
         
         self.input_path = os.path.join(root_dir, input_filename)
         self.target_path = os.path.join(root_dir, target_filename)
@@ -57,30 +95,89 @@ class CAMELSDatasetHDF5(Dataset):
                 f"Target HDF5 file not found: {self.target_path}"
             )
         
-        # Open HDF5 files to get dataset info
-        with h5py.File(self.input_path, 'r') as f:
+        # Open each file once to read dataset info and (optionally) cache it.
+        # These handles are closed again before any DataLoader worker forks.
+        with h5py.File(self.input_path, 'r', **H5_CHUNK_CACHE) as in_file, \
+                h5py.File(self.target_path, 'r', **H5_CHUNK_CACHE) as tgt_file:
             # HDF5 structure: {'Maps_Mcdm': (n_sims, height, width)}
-            self.n_simulations = f['Maps_Mcdm'].shape[0]
-            self.map_shape = f['Maps_Mcdm'].shape[1:]
+            in_ds = in_file['Maps_Mcdm']
+            tgt_ds = tgt_file['Maps_Mtot']
+            self.n_simulations = in_ds.shape[0]
+            self.map_shape = in_ds.shape[1:]
+            # Number of maps stored per HDF5 chunk (1 for contiguous layout)
+            self.chunk_rows = in_ds.chunks[0] if in_ds.chunks else 1
             print(f"  Found {self.n_simulations} simulations, each {self.map_shape}")
+            
+            # Files written by preprocess.py are tagged as already normalized
+            in_normalized = in_ds.attrs.get('normalization') == 'log1p'
+            tgt_normalized = tgt_ds.attrs.get('normalization') == 'log1p'
+            if in_normalized != tgt_normalized:
+                raise ValueError(
+                    "Input and target files disagree on normalization: "
+                    f"input log1p={in_normalized}, target log1p={tgt_normalized}"
+                )
+            self.normalized = in_normalized
+            
+            # Optionally cache entire dataset in memory
+            if cache_in_memory:
+                print("  Caching dataset in memory (this may take a moment)...")
+                # read_direct converts to float32 while reading, avoiding a
+                # second full-size allocation for the cast
+                self.input_cache = np.empty(in_ds.shape, dtype=np.float32)
+                self.target_cache = np.empty(tgt_ds.shape, dtype=np.float32)
+                in_ds.read_direct(self.input_cache)
+                tgt_ds.read_direct(self.target_cache)
+                print("  ✓ Dataset cached!")
+            else:
+                self.input_cache = None
+                self.target_cache = None
         
-        # Optionally cache entire dataset in memory
-        if cache_in_memory:
-            print("  Caching dataset in memory (this may take a moment)...")
-            with h5py.File(self.input_path, 'r') as f:
-                self.input_cache = f['Maps_Mcdm'][:].astype(np.float32)
-            with h5py.File(self.target_path, 'r') as f:
-                self.target_cache = f['Maps_Mtot'][:].astype(np.float32)
-            print("  ✓ Dataset cached!")
-        else:
-            self.input_cache = None
-            self.target_cache = None
+        # HDF5 handles aren't fork-safe, so each process opens its own on
+        # first access and keeps them open. Handles inherited through a fork
+        # (e.g. the parent read a sample before starting DataLoader workers)
+        # are detected by PID and never used in the child.
+        self._reset_handles()
             
+    def _reset_handles(self):
+        self._pid = None
+        self._in_file = None
+        self._tgt_file = None
+        self._in_ds = None
+        self._tgt_ds = None
+
+    def _open_files(self):
+        """Open persistent HDF5 handles for reading samples."""
+        self._pid = os.getpid()
+        self._in_file = h5py.File(self.input_path, 'r', **H5_CHUNK_CACHE)
+        self._tgt_file = h5py.File(self.target_path, 'r', **H5_CHUNK_CACHE)
+        self._in_ds = self._in_file['Maps_Mcdm']
+        self._tgt_ds = self._tgt_file['Maps_Mtot']
+
+    def _ensure_open(self):
+        """Open the handles unless this process already owns open ones."""
+        if self._in_file is None or self._pid != os.getpid():
+            self._open_files()
+
+    def __getstate__(self):
+        # h5py handles can't be pickled; DataLoader workers reopen them
+        state = self.__dict__.copy()
+        for key in ('_pid', '_in_file', '_tgt_file', '_in_ds', '_tgt_ds'):
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset_handles()
+
     def __len__(self):
         return self.n_simulations
     
     def __getitem__(self, idx):
         """
+        Returns raw (un-normalized) maps unless reading preprocessed files;
+        log1p is applied on the training device after the batch has been
+        transferred.
+        
         Returns:
             input_tensor: (1, H, W) - Dark matter map
             target_tensor: (1, H, W) - Total matter map
@@ -90,15 +187,13 @@ class CAMELSDatasetHDF5(Dataset):
             input_map = self.input_cache[idx]
             target_map = self.target_cache[idx]
         else:
-            # Load from disk on-the-fly
-            with h5py.File(self.input_path, 'r') as f:
-                input_map = f['Maps_Mcdm'][idx].astype(np.float32)
-            with h5py.File(self.target_path, 'r') as f:
-                target_map = f['Maps_Mtot'][idx].astype(np.float32)
-        
-        # Normalize: log1p handles large dynamic range
-        input_map = np.log1p(input_map)
-        target_map = np.log1p(target_map)
+            # Load from disk on-the-fly; read_direct converts to float32
+            # while reading, so each map is allocated exactly once
+            self._ensure_open()
+            input_map = np.empty(self.map_shape, dtype=np.float32)
+            target_map = np.empty(self.map_shape, dtype=np.float32)
+            self._in_ds.read_direct(input_map, source_sel=np.s_[idx])
+            self._tgt_ds.read_direct(target_map, source_sel=np.s_[idx])
         
         # Convert to PyTorch tensors and add channel dimension
         input_tensor = torch.from_numpy(input_map).unsqueeze(0)
@@ -106,6 +201,77 @@ class CAMELSDatasetHDF5(Dataset):
         
         return input_tensor, target_tensor
 
+    def __getitems__(self, indices):
+        """
+        Batched version of __getitem__, picked up automatically by DataLoader.
+        Reads all requested maps with one sorted HDF5 selection instead of
+        one read per sample, then restores the requested order.
+        """
+        unique_idx, inverse = np.unique(np.asarray(indices), return_inverse=True)
+        
+        if self.cache_in_memory:
+            input_maps = self.input_cache[unique_idx]
+            target_maps = self.target_cache[unique_idx]
+        else:
+            self._ensure_open()
+            # h5py fancy selections must be increasing and unique
+            batch_shape = (len(unique_idx),) + tuple(self.map_shape)
+            input_maps = np.empty(batch_shape, dtype=np.float32)
+            target_maps = np.empty(batch_shape, dtype=np.float32)
+            selection = np.s_[unique_idx.tolist()]
+            self._in_ds.read_direct(input_maps, source_sel=selection)
+            self._tgt_ds.read_direct(target_maps, source_sel=selection)
+        
+        # Add channel dimension
+        input_tensor = torch.from_numpy(input_maps).unsqueeze(1)
+        target_tensor = torch.from_numpy(target_maps).unsqueeze(1)
+        
+        return [(input_tensor[i], target_tensor[i]) for i in inverse]
+
+
+class ChunkBatchSampler(Sampler):
+    """
+    Batch sampler that groups indices by HDF5 chunk, so each batch touches
+    as few chunks as possible. Chunks are visited in random order and
+    shuffled internally, so batches still differ from epoch to epoch.
+    
+    Args:
+        indices (sequence): Dataset index for each sampler position, e.g.
+            range(len(dataset)) or the .indices of a Subset
+        batch_size (int): Number of samples per batch
+        chunk_rows (int): Maps per HDF5 chunk (CAMELSDatasetHDF5.chunk_rows)
+        shuffle (bool): Shuffle chunk order and samples within chunks (default: True)
+        drop_last (bool): Drop the final incomplete batch (default: False)
+    """
+    def __init__(self, indices, batch_size, chunk_rows, shuffle=True, drop_last=False):
+        self.indices = list(indices)
+        self.batch_size = batch_size
+        self.chunk_rows = max(1, chunk_rows)
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+    
+    def __iter__(self):
+        groups = {}
+        for position, idx in enumerate(self.indices):
+            groups.setdefault(idx // self.chunk_rows, []).append(position)
+        chunks = [groups[key] for key in sorted(groups)]
+        
+        if self.shuffle:
+            chunks = [chunks[i] for i in torch.randperm(len(chunks)).tolist()]
+            chunks = [[chunk[i] for i in torch.randperm(len(chunk)).tolist()] for chunk in chunks]
+        
+        order = [position for chunk in chunks for position in chunk]
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            if self.drop_last and len(batch) < self.batch_size:
+                return
+            yield batch
+    
+    def __len__(self):
+        if self.drop_last:
+            return len(self.indices) // self.batch_size
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
 
 def load_camels_parameters(root_dir, suite='IllustrisTNG', dataset_type='CV'):
     """
@@ -114,15 +280,10 @@ def load_camels_parameters(root_dir, suite='IllustrisTNG', dataset_type='CV'):
     CAMELS provides these in a text file: params_<suite>_<type>.txt
     
     Returns:
-        params_df: pandas DataFrame with columns like:
+        params: dict mapping each column name to a float32 array with one
+            value per simulation, e.g.:
             - Omega_m, sigma_8, A_SN1, A_SN2, A_AGN1, A_AGN2, etc.
     """
-    try:
-        import pandas as pd
-    except ImportError:
-        print("Warning: pandas not installed. Cannot load parameters.")
-        return None
-    
     param_file = os.path.join(root_dir, f"params_{suite}_{dataset_type}.txt")
     
     if not os.path.exists(param_file):
@@ -130,11 +291,26 @@ def load_camels_parameters(root_dir, suite='IllustrisTNG', dataset_type='CV'):
         print("Simulations will not have associated parameters.")
         return None
     
-    # Load parameter file (usually space-separated)
-    params_df = pd.read_csv(param_file, delim_whitespace=True)
-    print(f"Loaded {len(params_df)} parameter sets from {param_file}")
+    # Load parameter file (whitespace-separated, column names on the first line)
+    with open(param_file) as f:
+        header = f.readline().lstrip('#').split()
+    try:
+        values = np.loadtxt(param_file, skiprows=1, dtype=np.float32, ndmin=2)
+    except ValueError as e:
+        print(f"Warning: Could not parse parameter file {param_file}: {e}")
+        print("Only numeric columns are supported.")
+        return None
     
-    return params_df
+    if values.shape[1] != len(header):
+        print(f"Warning: Parameter file {param_file} has {len(header)} column names "
+              f"but {values.shape[1]} data columns (or no data rows).")
+        print("Simulations will not have associated parameters.")
+        return None
+    
+    params = {name: values[:, i] for i, name in enumerate(header)}
+    print(f"Loaded {len(values)} parameter sets from {param_file}")
+    
+    return params
 
 
 if __name__ == '__main__':
@@ -159,12 +335,20 @@ if __name__ == '__main__':
         print(f"  Input shape:  {input_tensor.shape}")
         print(f"  Target shape: {target_tensor.shape}")
         
+        # Batched, chunk-aware loading
+        batch_sampler = ChunkBatchSampler(
+            range(len(dataset_hdf5)), batch_size=4, chunk_rows=dataset_hdf5.chunk_rows
+        )
+        loader = DataLoader(dataset_hdf5, batch_sampler=batch_sampler)
+        batch_input, batch_target = next(iter(loader))
+        print(f"  Batch input shape: {batch_input.shape}")
+        
         # 2. Test parameter loading
         print("\nTest 2: Loading simulation parameters...")
         params = load_camels_parameters(test_data_dir)
         if params is not None:
-            print(f"  Columns: {list(params.columns)}")
-            print(f"  First row:\n{params.iloc[0]}")
+            print(f"  Columns: {list(params)}")
+            print(f"  First row: {({name: float(col[0]) for name, col in params.items()})}")
         
         print("\n=== All Tests Passed! ===\n")
         
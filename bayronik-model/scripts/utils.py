@@ -0,0 +1,59 @@
+import torch
+
+
+class CUDAPrefetcher:
+    """
+    Wraps a DataLoader and copies the next batch to the GPU on a side
+    stream while the current batch is being processed, so host-to-device
+    transfers overlap with the forward/backward pass.
+
+    Works best with a DataLoader created with pin_memory=True.
+
+    Args:
+        loader (DataLoader): The loader yielding (data, targets) batches
+        device (str): The CUDA device to copy batches to (default: 'cuda')
+    """
+    def __init__(self, loader, device='cuda'):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream()
+        self.next_data = None
+        self.next_targets = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.loader_iter = iter(self.loader)
+        self.preload()
+        return self
+
+    def preload(self):
+        """Fetch the next batch and start copying it on the side stream."""
+        try:
+            data, targets = next(self.loader_iter)
+        except StopIteration:
+            self.next_data = None
+            self.next_targets = None
+            return
+
+        with torch.cuda.stream(self.stream):
+            self.next_data = data.to(self.device, non_blocking=True)
+            self.next_targets = targets.to(self.device, non_blocking=True)
+
+    def __next__(self):
+        if self.next_data is None:
+            raise StopIteration
+
+        # Make the compute stream wait for the copy to finish
+        current_stream = torch.cuda.current_stream()
+        current_stream.wait_stream(self.stream)
+        data, targets = self.next_data, self.next_targets
+
+        # Tell the caching allocator these tensors are now used on the
+        # compute stream so their memory isn't reused too early
+        data.record_stream(current_stream)
+        targets.record_stream(current_stream)
+
+        self.preload()
+        return data, targets
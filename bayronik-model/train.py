@@ -1,84 +1,274 @@
 import torch
 import torch.nn as nn
 import torch.optim as optim
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.utils.data import DataLoader, random_split
+from torch.utils.data.distributed import DistributedSampler
 import os
+import threading
 import wandb
 
 # Import our custom modules
 import config
 from scripts.dataset import CAMELSDataset
 from scripts.model import UNet
+from scripts.utils import CUDAPrefetcher
+
+def setup_distributed():
+    """
+    Initialize torch.distributed when launched with torchrun
+    (e.g. `torchrun --nproc_per_node=8 train.py`).
+
+    Returns:
+        (distributed, rank, local_rank): distributed is False for a plain
+        `python train.py` run, in which case rank and local_rank are 0.
+    """
+    if int(os.environ.get("WORLD_SIZE", 1)) <= 1:
+        return False, 0, 0
+
+    if config.DEVICE != "cuda":
+        raise RuntimeError(
+            f"Distributed training (WORLD_SIZE > 1) requires CUDA, but config.DEVICE is "
+            f"'{config.DEVICE}'. Run `python train.py` for single-device training instead."
+        )
+
+    dist.init_process_group("nccl")
+    local_rank = int(os.environ["LOCAL_RANK"])
+    # After this, "cuda" refers to this process's own GPU
+    torch.cuda.set_device(local_rank)
+    return True, dist.get_rank(), local_rank
+
+def cpu_state_dict(model):
+    """Copy the model weights to CPU without moving the model itself."""
+    non_blocking = (config.DEVICE == "cuda")
+    cpu_state = {
+        k: v.detach().to("cpu", non_blocking=non_blocking) for k, v in model.state_dict().items()
+    }
+    if non_blocking:
+        # Make sure the copies have landed before anyone reads them
+        torch.cuda.synchronize()
+    return cpu_state
+
+class CheckpointWriter(threading.Thread):
+    """Runs torch.save in the background and re-raises any failure on join()."""
+
+    def __init__(self, state, path):
+        super().__init__()
+        self.state = state
+        self.path = path
+        self.error = None
+
+    def run(self):
+        try:
+            torch.save(self.state, self.path)
+        except Exception as e:
+            self.error = e
+
+    def join(self, timeout=None):
+        super().join(timeout)
+        if self.error is not None:
+            raise self.error
+
+def save_state_dict_async(model, path):
+    """
+    Snapshot the model weights to CPU, then write them to disk on a
+    background thread so training can carry on while the file is flushed.
+
+    Returns:
+        The CheckpointWriter; join it before reusing the same path.
+    """
+    writer = CheckpointWriter(cpu_state_dict(model), path)
+    writer.start()
+    return writer
+
+def finish_checkpoint(writer):
+    """Wait for a background checkpoint write and report whether it succeeded."""
+    try:
+        writer.join()
+        print(f"  ✓ Best model saved to {writer.path}")
+    except Exception as e:
+        print("\n---! AN ERROR OCCURRED WHILE SAVING THE BEST MODEL !---")
+        print(f"Error type: {type(e).__name__}")
+        print(f"Error message: {e}")
+        print(f"The best model was NOT saved to {writer.path}.")
 
 def train_model():
     """Main function to orchestrate the model training process."""
-    wandb.init(
-        project="bayronik-emulator",
-        config={
-            "learning_rate": config.LEARNING_RATE,
-            "architecture": "U-Net",
-            "dataset": f"{config.SUITE}-{config.DATASET_TYPE}",
-            "epochs": config.NUM_EPOCHS,
-            "batch_size": config.BATCH_SIZE,
-        }
-    )
-    print(f"--- Starting Training on {config.DEVICE} ---")
-    print("--- Weights & Biases tracking is enabled ---")
+    distributed, rank, local_rank = setup_distributed()
+    # Only rank 0 logs to W&B and writes checkpoints
+    is_main = (rank == 0)
+
+    if is_main:
+        wandb.init(
+            project="bayronik-emulator",
+            config={
+                "learning_rate": config.LEARNING_RATE,
+                "architecture": "U-Net",
+                "dataset": f"{config.SUITE}-{config.DATASET_TYPE}",
+                "epochs": config.NUM_EPOCHS,
+                "batch_size": config.BATCH_SIZE,
+            }
+        )
+        print(f"--- Starting Training on {config.DEVICE} ---")
+        if distributed:
+            print(f"--- Distributed training across {dist.get_world_size()} processes ---")
+        print("--- Weights & Biases tracking is enabled ---")
 
     # 1. Load Data
-    print("Loading dataset...")
+    if is_main:
+        print("Loading dataset...")
     full_dataset = CAMELSDataset(
         root_dir=config.DATA_DIR,
         suite=config.SUITE,
-        dataset_type=config.DATASET_TYPE
+        dataset_type=config.DATASET_TYPE,
+        verbose=is_main
     )
     val_size = int(len(full_dataset) * 0.1)
     train_size = len(full_dataset) - val_size
-    train_dataset, val_dataset = random_split(full_dataset, [train_size, val_size])
+    # Fixed seed so every rank gets the same train/validation split
+    train_dataset, val_dataset = random_split(
+        full_dataset, [train_size, val_size], generator=torch.Generator().manual_seed(0)
+    )
+    # Under DDP each rank loads its own shard; the sampler does the shuffling
+    train_sampler = DistributedSampler(train_dataset, shuffle=True) if distributed else None
+    val_sampler = DistributedSampler(val_dataset, shuffle=False) if distributed else None
+    # Pinned host memory only pays off for CUDA host-to-device copies
+    pin = (config.DEVICE == "cuda")
+    persistent = (config.NUM_WORKERS > 0)
+    # The compiled model is specialized on one input shape, so every training
+    # batch must be full; validation keeps its partial batch (see below)
+    compile_model = (config.DEVICE == "cuda")
     train_loader = DataLoader(
-        train_dataset, batch_size=config.BATCH_SIZE, num_workers=config.NUM_WORKERS, shuffle=True
+        train_dataset, batch_size=config.BATCH_SIZE, num_workers=config.NUM_WORKERS,
+        shuffle=(train_sampler is None), sampler=train_sampler,
+        pin_memory=pin, persistent_workers=persistent, drop_last=compile_model
     )
     val_loader = DataLoader(
-        val_dataset, batch_size=config.BATCH_SIZE, num_workers=config.NUM_WORKERS, shuffle=False
+        val_dataset, batch_size=config.BATCH_SIZE, num_workers=config.NUM_WORKERS, shuffle=False,
+        sampler=val_sampler, pin_memory=pin, persistent_workers=persistent
     )
-    print(f"Data loaded. Training size: {train_size}, Validation size: {val_size}")
+    input_shape = (config.BATCH_SIZE,) + tuple(full_dataset[0][0].shape)
+    # Preprocessed datasets already store log1p-normalized maps
+    normalize_on_device = not full_dataset.normalized
+    if is_main:
+        print(f"Data loaded. Training size: {train_size}, Validation size: {val_size}")
+
+    # On CUDA, overlap the host-to-device copy of the next batch with compute
+    if config.DEVICE == "cuda":
+        train_batches = CUDAPrefetcher(train_loader, config.DEVICE)
+        val_batches = CUDAPrefetcher(val_loader, config.DEVICE)
+    else:
+        train_batches = train_loader
+        val_batches = val_loader
 
     # 2. Initialize Model, Loss, and Optimizer
     model = UNet(n_channels=1, n_classes=1).to(config.DEVICE)
+    # NHWC activations let cuDNN use Tensor Core kernels without layout transposes
+    memory_format = torch.channels_last if config.DEVICE == "cuda" else torch.contiguous_format
+    model = model.to(memory_format=memory_format)
+    # Keep a handle on the eager module so saved state_dict keys stay
+    # free of the compiled wrapper's "_orig_mod." prefix
+    raw_model = model
+    if distributed:
+        # Gradients are all-reduced across ranks, overlapped with backward
+        model = DDP(model, device_ids=[local_rank])
+    if compile_model:
+        # Inductor fuses the conv/BN/ReLU epilogues and cuts kernel launches.
+        # dynamic=False specializes the kernels on the exact input shape; the
+        # cache limit of 2 (one graph for train mode, one for eval mode)
+        # makes any unexpected recompilation visible instead of silent.
+        torch._dynamo.config.cache_size_limit = 2
+        # DDP splits the graph at gradient bucket boundaries, so fullgraph
+        # is only requested for single-process runs
+        model = torch.compile(
+            model, mode="max-autotune", dynamic=False, fullgraph=not distributed
+        )
     loss_fn = nn.MSELoss()
-    optimizer = optim.Adam(model.parameters(), lr=config.LEARNING_RATE)
+    # The fused CUDA kernel updates all parameters in a single launch
+    optimizer = optim.Adam(
+        model.parameters(), lr=config.LEARNING_RATE, fused=(config.DEVICE == "cuda")
+    )
+
+    # Mixed precision (BF16) on CUDA; other devices run in full FP32
+    use_amp = (config.DEVICE == "cuda")
+    amp_device = "cuda" if use_amp else "cpu"
+    scaler = torch.amp.GradScaler("cuda", enabled=use_amp)
+    if use_amp:
+        # Input shape is fixed, so let cuDNN benchmark and pick the fastest conv algorithms
+        torch.backends.cudnn.benchmark = True
+        # Allow TF32 for any matmuls/convs that stay in FP32
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
 
     # 3. Training Loop with Validation
-    print("\n--- Entering Training Loop ---")
+    if is_main:
+        print("\n--- Entering Training Loop ---")
     best_val_loss = float('inf')
+    best_model_writer = None
     
     for epoch in range(config.NUM_EPOCHS):
+        if train_sampler is not None:
+            # Reshuffle the shards differently every epoch
+            train_sampler.set_epoch(epoch)
+
         # --- Training Phase ---
         model.train()
-        running_loss = 0.0
-        for data, targets in train_loader:
-            data = data.to(config.DEVICE)
-            targets = targets.to(config.DEVICE)
-            predictions = model(data)
-            loss = loss_fn(predictions, targets)
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-            running_loss += loss.item()
-        avg_train_loss = running_loss / len(train_loader)
+        # Accumulate on the device so the loop never blocks on a GPU->CPU sync
+        running_loss = torch.zeros((), device=config.DEVICE)
+        for data, targets in train_batches:
+            if compile_model and data.shape != input_shape:
+                raise ValueError(
+                    f"Batch shape {tuple(data.shape)} does not match the compiled shape {input_shape}"
+                )
+            data = data.to(config.DEVICE, non_blocking=True)
+            targets = targets.to(config.DEVICE, non_blocking=True)
+            # Normalize on the device: log1p handles the large dynamic range
+            if normalize_on_device:
+                data = torch.log1p(data)
+                targets = torch.log1p(targets)
+            data = data.contiguous(memory_format=memory_format)
+            targets = targets.contiguous(memory_format=memory_format)
+            optimizer.zero_grad(set_to_none=True)
+            with torch.autocast(device_type=amp_device, dtype=torch.bfloat16, enabled=use_amp):
+                predictions = model(data)
+                loss = loss_fn(predictions, targets)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            running_loss += loss.detach()
+        running_loss /= len(train_loader)
+        if distributed:
+            dist.all_reduce(running_loss, op=dist.ReduceOp.AVG)
+        avg_train_loss = running_loss.item()
         
         # --- Validation Phase ---
         model.eval()
-        val_loss = 0.0
+        val_loss = torch.zeros((), device=config.DEVICE)
         with torch.no_grad():
-            for data, targets in val_loader:
-                data = data.to(config.DEVICE)
-                targets = targets.to(config.DEVICE)
-                predictions = model(data)
-                loss = loss_fn(predictions, targets)
-                val_loss += loss.item()
-        avg_val_loss = val_loss / len(val_loader)
+            for data, targets in val_batches:
+                # The compiled model only takes full batches; score the leftover
+                # partial batch with the eager module so every map counts
+                eval_model = raw_model if compile_model and data.shape != input_shape else model
+                data = data.to(config.DEVICE, non_blocking=True)
+                targets = targets.to(config.DEVICE, non_blocking=True)
+                if normalize_on_device:
+                    data = torch.log1p(data)
+                    targets = torch.log1p(targets)
+                data = data.contiguous(memory_format=memory_format)
+                targets = targets.contiguous(memory_format=memory_format)
+                with torch.autocast(device_type=amp_device, dtype=torch.bfloat16, enabled=use_amp):
+                    predictions = eval_model(data)
+                    loss = loss_fn(predictions, targets)
+                val_loss += loss.detach()
+        val_loss /= len(val_loader)
+        if distributed:
+            dist.all_reduce(val_loss, op=dist.ReduceOp.AVG)
+        avg_val_loss = val_loss.item()
         
+        if not is_main:
+            continue
+
         # --- Logging ---
         print(f"Epoch {epoch+1}/{config.NUM_EPOCHS} -> Train Loss: {avg_train_loss:.6f} | Val Loss: {avg_val_loss:.6f}")
         wandb.log({
@@ -92,8 +282,14 @@ def train_model():
             best_val_loss = avg_val_loss
             best_model_path = os.path.join(config.WEIGHTS_DIR, f"best_{config.MODEL_NAME}")
             os.makedirs(config.WEIGHTS_DIR, exist_ok=True)
-            torch.save(model.state_dict(), best_model_path)
-            print(f"  ✓ New best model saved (val_loss: {avg_val_loss:.6f})")
+            if best_model_writer is not None:
+                finish_checkpoint(best_model_writer)
+            print(f"  Saving new best model (val_loss: {avg_val_loss:.6f})...")
+            best_model_writer = save_state_dict_async(raw_model, best_model_path)
+
+    if not is_main:
+        dist.destroy_process_group()
+        return
 
     print("\n--- Training Finished ---")
     print("--- Proceeding to save model weights. ---")
@@ -106,11 +302,9 @@ def train_model():
         model_path = os.path.join(config.WEIGHTS_DIR, config.MODEL_NAME)
         print(f"Step 2: Preparing to save model to: {model_path}")
         
-        # --- THE FIX: Move model to CPU before saving ---
-        print("Step 3: Moving model to CPU for safe saving...")
-        model.to("cpu")
-        
-        torch.save(model.state_dict(), model_path)
+        # Weights are copied to CPU for saving; the model itself stays put
+        print("Step 3: Copying weights to CPU and saving...")
+        torch.save(cpu_state_dict(raw_model), model_path)
         
         print("Step 4: torch.save command executed successfully.")
         print(f"Model saved to {model_path}")
@@ -121,11 +315,17 @@ def train_model():
         print(f"Error message: {e}")
         print("The model was NOT saved.")
     
+    if best_model_writer is not None:
+        finish_checkpoint(best_model_writer)
+
     # --- Finalize W&B run ---
     print("\nFinalizing Weights & Biases run...")
     wandb.finish()
     print("W&B run finished.")
 
+    if distributed:
+        dist.destroy_process_group()
+
 if __name__ == "__main__":
     train_model()
 